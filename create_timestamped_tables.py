@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 """A script to update the logs.* and logs_hourly.* bigquery tables.
 
@@ -22,20 +22,24 @@ broken up into multiple bigquery rows in the streaming logs.  This
 script connects each request-log row with all its app-logs row in the
 streaming logs, and combines them into a single record when writing to
 the daily-log/hourly-log tables.
+
+This script needs the google-cloud-bigquery python package to be
+installed and authenticated.
 """
 
-import calendar
+import collections
+import concurrent.futures
 import datetime
 import json
 import logging
-import os
-import random
-import re
 import signal
-import subprocess
 import sys
+import threading
 import time
 
+from google.api_core import exceptions as api_exceptions
+from google.cloud import bigquery
+
 import update_schema
 
 
@@ -44,8 +48,36 @@ _PROJECT = 'khanacademy.org:deductive-jet-827'
 _HOURLY_DATASET = 'logs_hourly'
 _DAILY_DATASET = 'logs'
 
+# strftime formats for the names of the tables we create.
+_HOURLY_TABLE_ID_FORMAT = 'requestlogs_%Y%m%d_%H'
+_HOURLY_TABLE_FORMAT = _HOURLY_DATASET + '.' + _HOURLY_TABLE_ID_FORMAT
+_DAILY_TABLE_FORMAT = _DAILY_DATASET + '.requestlogs_%Y%m%d'
+
+# All our bigquery jobs go through this one client, so we only pay for
+# auth and connection setup once, rather than once per `bq` command.
+# _client() makes it the first time we need it, so that importing this
+# module, or running it with --help, doesn't need credentials.
+_CLIENT = None
+
+# When catching up on a lot of missing hours, we build this many
+# hourly tables at once.  Almost all our time is spent waiting for
+# bigquery jobs to get scheduled and run, so this is a big win.
+_MAX_CONCURRENT_HOURS = 8
+
+# How often we check, while waiting for a bigquery job, whether
+# we've been asked to shut down.
+_JOB_POLL_SECONDS = 10
 
-# This string should be instantiated with a dict with these fields:
+# How long _table_decorator_end_time waits for the streaming logs to
+# catch up before giving up, in seconds.
+_MAX_STREAMING_WAIT_SECONDS = 2 * 60 * 60
+
+# Set when we get a signal, to tell the threads building hourly
+# tables to stop what they're doing and clean up.
+_SHUTDOWN = threading.Event()
+
+
+# These queries take the following query parameters:
 #    start_time: the time_t to start this hourly log, in seconds.
 #       It should probably be on the hour.  We will log all messages
 #       which *finished* >= start_time.
@@ -62,41 +94,62 @@ _DAILY_DATASET = 'logs'
 #       https://groups.google.com/a/khanacademy.org/forum/#!topic/infrastructure-team/Y2qG9SH5S3o
 # Note that our start_time and end_time and only kinda related to the
 # bigquery columns entitled 'start_time' and 'end_time'.  So confusing!
-# TODO(csilvers): figure out a way to distinguish vm loglines from non-vm
-#                 loglines without hard-coding module names.
-_VM_SUBTABLE_QUERY = """\
-SELECT *
-FROM [khan-academy:logs_streaming.logs_all_time@%(start_ms)s-%(end_ms)s]
-WHERE end_time >= %(start_time)s and end_time < %(end_time)s
-      AND module_id = 'vm'
+# APPENDS() is the standard-sql version of a legacy-sql table
+# decorator: it only reads the rows that were added to the streaming
+# table between the two times.  It also adds a few columns of its own
+# describing the change, which we don't want.
+_HOURLY_LOGS_QUERY = """\
+SELECT * EXCEPT (_CHANGE_TYPE, _CHANGE_TIMESTAMP)
+FROM APPENDS(TABLE `khan-academy.logs_streaming.logs_all_time`,
+             TIMESTAMP_MILLIS(@start_ms), TIMESTAMP_MILLIS(@end_ms))
+WHERE end_time >= @start_time and end_time < @end_time
 """
 
+# The queries below don't read the streaming table themselves.
+# Instead they read `hourly_logs`, a temp table that holds the result
+# of _HOURLY_LOGS_QUERY, so we only read the streaming table once.
+# TODO(csilvers): figure out a way to distinguish vm loglines from non-vm
+#                 loglines without hard-coding module names.
+# This string should be instantiated with a dict with this field:
+#   hourly_table_fields: all the fields in an hourly table, as a
+#       comma-joined string.  This is all the fields in the streaming
+#       schema, in the streaming schema's order.
 _NON_VM_SUBTABLE_QUERY = """\
-SELECT *
-FROM [khan-academy:logs_streaming.logs_all_time@%(start_ms)s-%(end_ms)s]
-WHERE end_time >= %(start_time)s and end_time < %(end_time)s
-      AND module_id != 'vm'
+SELECT %(hourly_table_fields)s
+FROM hourly_logs
+WHERE module_id != 'vm'
 """
 
-# This needs a dict with all the field listed above, *plus*:
-#   vm_filtered_temptable: the name given the table created by
-#       _VM_SUBTABLE_QUERY.
+# In addition to the query parameters above, this string should be
+# instantiated with a dict with these fields:
 #   reqlog_fields: all the fields in the streaming schema that come
 #       just from the request-logs, as a comma-joined string: that's
 #       everything except `app_logs` and fields derived from it, such
 #       as `elog_*`.
-#   kalog_fields: all the fields derived from `app_logs` -- in particular
-#       the KA_LOG app-log line -- as a comma-joined string.
-#   concatted_kalog_fields: like kalog_fields, but with every field in
-#       the value converted into the string
-#       "ANY_VALUE(kalog_line.<kalog_field>) as <kalog_field>"
+#   concatted_kalog_fields: all the fields derived from `app_logs` --
+#       in particular the KA_LOG app-log line -- as a comma-joined
+#       string, with every field converted into the string
+#       "ANY_VALUE(IF(<is a kalog line>, <kalog_field>, NULL))
+#           as <kalog_field>"
+#   vm_hourly_table_fields: all the fields this query outputs, as a
+#       comma-joined string.  These match hourly_table_fields, above,
+#       one for one, but the fields this query doesn't compute (such as
+#       bingo fields other than the two we hard-code) are given as
+#       "NULL as <field>".
 _VM_MODULES_QUERY = """\
 WITH
 
+-- All the vm-module lines for this hour.
+vm_filtered AS (
+    SELECT *
+    FROM hourly_logs
+    WHERE module_id = 'vm'
+),
+
 -- All the lines generated from the request-log.  These lack a thread-id.
 request AS (
     SELECT %(reqlog_fields)s
-    FROM %(vm_filtered_temptable)s
+    FROM vm_filtered
     WHERE (request_id != "null" AND request_id IS NOT NULL)
            AND (thread_id = "null" or thread_id IS NULL)
 ),
@@ -104,7 +157,7 @@ request AS (
 -- All the lines generated from the app-log.  These have a thread id.
 app_log AS (
     SELECT *
-    FROM %(vm_filtered_temptable)s
+    FROM vm_filtered
     WHERE thread_id != "null" AND thread_id IS NOT NULL
 ),
 
@@ -117,63 +170,157 @@ link_line AS (
     WHERE request_id != "null" AND request_id IS NOT NULL
 ),
 
--- The special app-log line that we emit at the end of each request that
--- we use to generate a bunch of computed log lines like elog_browser.
-kalog_line AS (
-    SELECT %(kalog_fields)s, thread_id
-    FROM app_log
-    -- We pick an arbitrary elog-field which is set for every request.
-    WHERE elog_country is not null
-),
-
--- And similar for the bigbingo fields.  We hard-code these.
--- TODO(csilvers): get rid of all these special lines (including
--- kalog_line entirely, maybe when we can use legacy sql with
--- table decorators so it doesn't insert a bunch of (null, null) records.
-bingo_participation_line AS (
-    SELECT bingo_participation_events, thread_id
-    FROM app_log
-    WHERE bingo_participation_events[SAFE_OFFSET(0)] is not null AND
-          bingo_participation_events[SAFE_OFFSET(0)].bingo_id is not null
-),
-bingo_conversion_line AS (
-    SELECT bingo_conversion_events, thread_id
-    FROM app_log
-    WHERE bingo_conversion_events[SAFE_OFFSET(0)] is not null AND
-          bingo_conversion_events[SAFE_OFFSET(0)].bingo_id is not null
-),
-
 -- One row for each request, but only for the app-log; we haven't
 -- merged with the request-log data yet.  This merges together a bunch
--- of `app_log` lines with the same thread_id, and also all the kalog
--- data.
+-- of `app_log` lines with the same thread_id.  We group by the link
+-- line's request_id, rather than by thread_id alone, since a thread-id
+-- can get reused for another request within the window we read; then
+-- each of those requests still gets a row, though each gets all the
+-- thread's app-log lines.  Every link line is itself an app_log line,
+-- so an inner join keeps every request, and drops threads that never
+-- logged a request-id.  Some of the app-log lines are special, and we
+-- take fields from just them:
+-- 1) The app-log line that we emit at the end of each request, that
+--    we use to generate a bunch of computed log lines like
+--    elog_browser.  We recognize it by an arbitrary elog-field which
+--    is set for every request: elog_country.
+-- 2) The bigbingo lines.  We hard-code these.
+-- ANY_VALUE() ignores NULLs, so it picks the value from the special
+-- line, all in the same pass over app_log.
 joined_applog_lines AS (
     SELECT ARRAY_CONCAT_AGG(app_log.app_logs) as app_logs,
            %(concatted_kalog_fields)s,
-           ANY_VALUE(bingo_participation_line.bingo_participation_events)
+           ANY_VALUE(IF(
+               app_log.bingo_participation_events[SAFE_OFFSET(0)]
+                   .bingo_id is not null,
+               app_log.bingo_participation_events, NULL))
                as bingo_participation_events,
-           ANY_VALUE(bingo_conversion_line.bingo_conversion_events)
+           ANY_VALUE(IF(
+               app_log.bingo_conversion_events[SAFE_OFFSET(0)]
+                   .bingo_id is not null,
+               app_log.bingo_conversion_events, NULL))
                as bingo_conversion_events,
            link_line.request_id as request_id
     FROM link_line
-    LEFT OUTER JOIN app_log
-    USING (thread_id)
-    LEFT OUTER JOIN kalog_line
-    USING (thread_id)
-    LEFT OUTER JOIN bingo_participation_line
-    USING (thread_id)
-    LEFT OUTER JOIN bingo_conversion_line
+    JOIN app_log
     USING (thread_id)
     GROUP BY link_line.request_id
 )
 
 -- And the final result: the app-log data merged with the request-log data!
-SELECT *
+SELECT %(vm_hourly_table_fields)s
 FROM request
 LEFT OUTER JOIN joined_applog_lines
 USING (request_id)
 """
 
+# This looks at the histogram of an hourly table's loglines, as
+# explained in _assert_hourly_logs_seem_complete().  It buckets the logs
+# by 5 minutes, which seems to be a good interval, and then looks for
+# the dip in bigquery itself, so we just get back a single row.  It
+# should be instantiated with a dict with this field:
+#   hourly_table: the name of the hourly table to look at.
+_HOURLY_HISTOGRAM_QUERY = """\
+WITH
+
+buckets AS (
+    SELECT FORMAT_TIMESTAMP(
+               '%%Y-%%m-%%d %%H:%%M:%%S',
+               TIMESTAMP_SECONDS(CAST(FLOOR(end_time / 300) AS INT64) * 300))
+               as `interval`,
+           COUNT(1) as count
+    FROM %(hourly_table)s
+    GROUP BY `interval`
+),
+
+-- How much each bucket went up or down, in percent, from the one
+-- before.  This is NULL for the first bucket.
+changes AS (
+    SELECT `interval`, count,
+           LAG(count) OVER (ORDER BY `interval`) AS prev_count,
+           (count - LAG(count) OVER (ORDER BY `interval`)) * 100
+               / LAG(count) OVER (ORDER BY `interval`) AS difference
+    FROM buckets
+),
+
+-- There's normal variation, so we only say a bucket starts a dip if
+-- the drop is more than, say, 5%%.  This number is arbitrary.  For
+-- each bucket, we find the most recent dip that started at or before
+-- it, and how many loglines there were just before that dip.
+dips AS (
+    SELECT `interval`, count, difference,
+           LAST_VALUE(IF(difference <= -5, `interval`, NULL) IGNORE NULLS)
+               OVER so_far AS dip_start,
+           LAST_VALUE(IF(difference <= -5, prev_count, NULL) IGNORE NULLS)
+               OVER so_far AS pre_dip_amount,
+           LAST_VALUE(IF(difference <= -5, difference, NULL) IGNORE NULLS)
+               OVER so_far AS dip_difference
+    FROM changes
+    WINDOW so_far AS (ORDER BY `interval`
+                      ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW)
+),
+
+-- The buckets where we're back to pre-dip levels (ignoring normal
+-- variance).  Note we ignore if the new value is too *high* in
+-- addition to too low, since that means something else weird is
+-- going on, and not a dip.
+recoveries AS (
+    SELECT dip_start, `interval` AS dip_end, dip_difference
+    FROM dips
+    WHERE difference > -5
+          AND (count - pre_dip_amount) * 100 / pre_dip_amount > -2
+          AND (count - pre_dip_amount) * 100 / pre_dip_amount < 5
+)
+
+SELECT
+    -- The first time we recovered from a dip, if we ever did.
+    (SELECT AS STRUCT * FROM recoveries ORDER BY dip_end LIMIT 1)
+        AS recovered_dip,
+    -- The last dip we saw, whether we recovered from it or not.
+    (SELECT AS STRUCT dip_start, dip_difference
+     FROM dips ORDER BY `interval` DESC LIMIT 1)
+        AS last_dip,
+    ARRAY(SELECT AS STRUCT `interval`, count FROM buckets ORDER BY `interval`)
+        AS histogram
+"""
+
+# This is the bigquery script that creates an hourly table.  It takes
+# the same query parameters as the queries above, and should be
+# instantiated with a dict with these fields:
+#   hourly_table: the name of the table to create.
+#   hourly_logs_query: _HOURLY_LOGS_QUERY.
+#   non_vm_query: _NON_VM_SUBTABLE_QUERY, already instantiated.
+#   vm_modules_query: _VM_MODULES_QUERY, already instantiated.
+#   histogram_query: _HOURLY_HISTOGRAM_QUERY, already instantiated.
+# Running all the statements as a single script means we only wait for
+# bigquery to schedule one job.  And since the hourly table is created
+# by a single statement, it either has all the logs or doesn't exist.
+# (UNION ALL matches up columns by position, not by name, which is why
+# both queries list the fields explicitly.)  The script ends with the
+# histogram query, so its one row is the result of the script job.
+_CREATE_HOURLY_TABLE_SCRIPT = """\
+-- All the loglines for this hour, which both queries below read from.
+CREATE TEMP TABLE hourly_logs AS
+%(hourly_logs_query)s;
+
+-- We cluster by module, then time, then status, so queries on just a few
+-- modules, or a part of the day, or just the errors, read less.  The
+-- daily table picks up the same clustering when the copy job creates it.
+-- (end_time is a FLOAT, which bigquery can't cluster on, so we use
+-- end_time_timestamp instead.)
+CREATE TABLE %(hourly_table)s
+CLUSTER BY module_id, end_time_timestamp, status
+AS
+-- The non-vm modules, which are very simple...
+(%(non_vm_query)s)
+UNION ALL
+-- ...and the vm modules, which need a lot more work.
+(%(vm_modules_query)s);
+
+-- Finally, a sanity check on what we just wrote.
+%(histogram_query)s;
+"""
+
 
 class HourlyTableIncomplete(Exception):
     pass
@@ -181,51 +328,119 @@ class HourlyTableIncomplete(Exception):
 
 def _now():
     """Now, as a time_t."""
-    return calendar.timegm(datetime.datetime.utcnow().timetuple())
+    return int(time.time())
+
+
+def _client():
+    """The bigquery client for _PROJECT, made on first use.
+
+    main() makes its first query before starting any worker threads,
+    so they all share the one client.
+    """
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = bigquery.Client(project=_PROJECT)
+    return _CLIENT
 
 
 def _hourly_table_name(start_time):
-    return start_time.strftime(_HOURLY_DATASET + '.requestlogs_%Y%m%d_%H')
+    return start_time.strftime(_HOURLY_TABLE_FORMAT)
+
 
+def _query_parameters(**params):
+    """Return the given keyword args as (integer) bigquery query params.
 
-def _sanitize_query(sql_query):
-    """Remove newlines and comments from the sql query, for the commandline."""
-    return re.sub(r'--.*', '', sql_query).replace('\n', ' ')
+    Passing values this way, rather than interpolating them into the
+    sql, keeps the text of our queries the same from hour to hour.
+    """
+    return [bigquery.ScalarQueryParameter(name, 'INT64', value)
+            for (name, value) in sorted(params.items())]
 
 
-def _call_bq(cmd_and_args, **kwargs):
-    """cmd_and_args is, e.g., ['query', 'SELECT * from ...']."""
-    dry_run = kwargs.pop('dry_run', False)
+def _check_for_shutdown():
+    """Raise RaisedSignal if main() has been told to exit."""
+    if _SHUTDOWN.is_set():
+        raise RaisedSignal("Shutting down")
 
-    cmd = (['bq', '-q', '--headless', '--format', 'none',
-            '--project_id', _PROJECT] +
-           cmd_and_args)
 
-    if dry_run:
-        logging.info("Would run %s", cmd)
-        return
+def _start_query(sql_query, query_params, interactive=False, dry_run=False):
+    """Start a query (or script) job; return the QueryJob.
+
+    query_params is a list of bigquery query parameters, probably
+    from _query_parameters().  This does not wait for the job to
+    finish: use _wait_for_job() for that.
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=query_params,
+        priority=(bigquery.QueryPriority.INTERACTIVE if interactive
+                  else bigquery.QueryPriority.BATCH),
+        dry_run=dry_run)
+
+    logging.debug("Starting query: %s", sql_query)
+    return _client().query(sql_query, job_config=job_config)
+
+
+def _wait_for_job(job):
+    """Wait for a bigquery job to finish, raising if it failed.
 
-    logging.debug("Running %s", cmd)
-    start_time = time.time()
+    While waiting we keep an eye out for main() telling us to shut
+    down, in which case we cancel the job and raise RaisedSignal.
+    We do the same if the signal itself interrupts us, which happens
+    when we're running in the main thread (e.g. for the daily copy).
+    """
+    start_time = time.monotonic()
     try:
-        subprocess.check_call(cmd, **kwargs)
+        while True:
+            _check_for_shutdown()
+            try:
+                return job.result(timeout=_JOB_POLL_SECONDS)
+            except concurrent.futures.TimeoutError:
+                pass
+    except RaisedSignal:
+        job.cancel()
+        # Cancelling is only a request: the job may finish, and commit,
+        # before bigquery gets to it.  Wait until it's done either way,
+        # so our caller can check job.error_result.
+        try:
+            job.result()
+        except Exception:
+            pass
+        raise
     finally:
-        elapsed_time = time.time() - start_time
-        logging.debug("bq command ran in %.2f seconds" % elapsed_time)
+        elapsed_time = time.monotonic() - start_time
+        logging.debug("bq job %s ran in %.2f seconds",
+                      job.job_id, elapsed_time)
+
+
+def _query_rows(sql_query, query_params=()):
+    """Run a query and return its result rows.
+
+    This is meant for small queries, such as sanity checks, whose
+    results we want to look at right away.
+    """
+    logging.debug("Running query: %s", sql_query)
+    return list(_client().query_and_wait(
+        sql_query,
+        job_config=bigquery.QueryJobConfig(
+            query_parameters=list(query_params))))
 
 
 def _logs_are_up_to_date(start_ms, end_ms, end_time):
-    # The second selected field is just to help with debugging.
-    query = ('SELECT MAX(end_time) >= %s, INTEGER(MAX(end_time)) '
-             'FROM [khan-academy:logs_streaming.logs_all_time@%s-%s]'
-             % (end_time, start_ms, end_ms))
-    r = subprocess.check_output(['bq', '-q', '--headless', '--format', 'csv',
-                                 'query', query])
-    if 'true' in r:
-        return True
-    logging.warning("Insufficient table decorator values: '%s' returned '%s'",
-                    query, r)
-    return False
+    """Return (are the logs up to date, max end_time we saw or None)."""
+    query = ('SELECT MAX(end_time) >= @end_time AS up_to_date, '
+             'CAST(FLOOR(MAX(end_time)) AS INT64) AS max_end_time '
+             'FROM APPENDS(TABLE `khan-academy.logs_streaming.logs_all_time`, '
+             'TIMESTAMP_MILLIS(@start_ms), TIMESTAMP_MILLIS(@end_ms))')
+    r = _query_rows(query, _query_parameters(
+        start_ms=start_ms, end_ms=end_ms, end_time=end_time))
+    max_end_time = r[0]['max_end_time'] if r else None
+    if r and r[0]['up_to_date']:
+        return (True, max_end_time)
+    logging.warning("Insufficient table decorator values: %s-%s for "
+                    "end-time %s returned '%s'",
+                    start_ms, end_ms, end_time,
+                    [dict(row.items()) for row in r])
+    return (False, max_end_time)
 
 
 def _table_decorator_end_time(end_time):
@@ -263,7 +478,8 @@ def _table_decorator_end_time(end_time):
 
     # Things are straightforward until we have to wait until the future...
     while end_ms < _now() * 1000:
-        if _logs_are_up_to_date(start_ms, end_ms, end_time):
+        _check_for_shutdown()
+        if _logs_are_up_to_date(start_ms, end_ms, end_time)[0]:
             return end_ms
         logging.warning("Reading logs %d seconds past end-time isn't enough, "
                         "trying a later time", (end_ms / 1000 - end_time))
@@ -271,21 +487,33 @@ def _table_decorator_end_time(end_time):
 
     # If we get here, even having end_ms be the present isn't enough.
     # We will just have to wait a while for more logs to come in.
+    # We wait about as long as the streaming logs seem to be behind,
+    # but give up eventually.
     logging.info("Waiting for streaming logs to get up to date.")
-    for i in xrange(10):
+    deadline = time.monotonic() + _MAX_STREAMING_WAIT_SECONDS
+    while time.monotonic() < deadline:
         end_ms = _now() * 1000
-        if _logs_are_up_to_date(start_ms, end_ms, end_time):
+        (up_to_date, max_end_time) = _logs_are_up_to_date(
+            start_ms, end_ms, end_time)
+        if up_to_date:
             return end_ms
-        wait = 60 * (1.5 ** i)   # friendly exponential backoff
-        logging.warning("Streaming logs not up to date, waiting %ds..." % wait)
-        time.sleep(wait)
+        if max_end_time is None:    # no logs at all yet, no idea how long
+            wait = 300
+        else:
+            wait = min(300, max(10, end_time - max_end_time + 5))
+        logging.warning("Streaming logs not up to date, waiting %ds...", wait)
+        _SHUTDOWN.wait(wait)
+        _check_for_shutdown()
 
     raise RuntimeError("Streaming logs never got up to date.")
 
 
-def _assert_hourly_logs_seem_complete(start_time):
+def _assert_hourly_logs_seem_complete(start_time, result):
     """Raise if the given table doesn't seem to have all the data it ought.
 
+    result is the row that _HOURLY_HISTOGRAM_QUERY returned for the
+    hourly table that starts at start_time.
+
     Normally the pub-sub that generates our logs_streaming input table
     works great, and inserts log-records to logs_stream in almost real
     time.  But sometimes it gets into trouble and starts delivering
@@ -310,59 +538,28 @@ def _assert_hourly_logs_seem_complete(start_time):
     seem way out of line with the best-fit curve.
     """
     hourly_log_table = _hourly_table_name(start_time)
-    # This buckets the logs by 5 minutes, which seems to be a good interval.
-    query = """\
-SELECT FORMAT_UTC_USEC(INTEGER(end_time / 300) * 300000000) as interval,
-       COUNT(1) as count
-FROM %(table)s
-GROUP BY interval
-ORDER BY interval
-""" % {
-    'table': hourly_log_table,
-    'YYYYMMDD_HH': start_time.strftime("%Y-%m-%d %H")
-}
-
-    results = subprocess.check_output(
-        ['bq', '-q', '--headless', '--project_id', _PROJECT,
-         '--format', 'json', 'query', query])
-    results = json.loads(results)
-
-    dip_start = None
-    dip_end = None
-    for i in xrange(1, len(results)):
-        new_count = int(results[i]['count'])
-        old_count = int(results[i - 1]['count'])
-        difference = (new_count - old_count) * 100.0 / old_count
-        # There's normal variation, so we only say it's a dip if
-        # the drop is more than, say, 5%.  This number is arbitrary.
-        if difference <= -5:
-            dip_start = results[i]['interval']
-            pre_dip_amount = old_count
-            dip_difference = difference
-        elif dip_start is not None:
-            difference_from_pre_dip = ((new_count - pre_dip_amount) * 100.0
-                                       / pre_dip_amount)
-            # If we're back to pre-dip levels (ignoring normal variance).
-            # Note we ignore if the new value is too *high* in addition
-            # to too low, since that means something else weird is going
-            # on, and not a dip.
-            if difference_from_pre_dip > -2 and difference_from_pre_dip < 5:
-                dip_end = results[i]['interval']
-                break
-
-    # If we just saw the dip start, but didn't see it end, it means
-    # that the dip happened at the end of the hour.  We need a bit
-    # more evidence of a dip to report a problem then, since it could
-    # just be normal traffic drop-off at the end of the day.
-    if dip_start and not dip_end and dip_difference <= -10:
-        dip_end = "the end of the hour"
-
-    if dip_start and dip_end:
+
+    if result['recovered_dip']:
+        dip_start = result['recovered_dip']['dip_start']
+        dip_end = result['recovered_dip']['dip_end']
+        dip_difference = result['recovered_dip']['dip_difference']
+    elif result['last_dip'] and result['last_dip']['dip_start']:
+        # If we just saw the dip start, but didn't see it end, it means
+        # that the dip happened at the end of the hour.  We need a bit
+        # more evidence of a dip to report a problem then, since it could
+        # just be normal traffic drop-off at the end of the day.
+        dip_start = result['last_dip']['dip_start']
+        dip_difference = result['last_dip']['dip_difference']
+        dip_end = "the end of the hour" if dip_difference <= -10 else None
+    else:
+        dip_end = None
+
+    if dip_end:
         raise HourlyTableIncomplete(
             "Error reading from streaming logs at %s: The logs from %s - %s "
             "have %.2f%% fewer loglines than expected:\n%s"
             % (hourly_log_table, dip_start, dip_end, -dip_difference,
-               '\n'.join(json.dumps(e) for e in results)))
+               '\n'.join(json.dumps(e) for e in result['histogram'])))
 
     # TODO(csilvers): if we saw a dip in this hour before, and now
     # it's gone, we may still want to wait another hour or two to see
@@ -393,18 +590,34 @@ def _times_of_missing_tables(end_time):
     """
     today = datetime.datetime.utcnow()
     midnight = datetime.datetime(today.year, today.month, today.day)
-    output = subprocess.check_output(['bq', '-q', '--headless',
-                                      '--format', 'json',
-                                      '--project_id', _PROJECT,
-                                      'ls', '-n', '100000', _HOURLY_DATASET])
-    if not output:
-        table_names = [None]
+    window_start = end_time - datetime.timedelta(days=6)
+
+    # Rather than listing every table in the dataset, we let bigquery
+    # tell us the first one, and just the ones that could be in our
+    # window: a table can't be created before the hour it holds.
+    query = ('WITH tables AS ('
+             '    SELECT table_name, creation_time '
+             '    FROM %s.INFORMATION_SCHEMA.TABLES '
+             '    WHERE STARTS_WITH(table_name, "requestlogs_")) '
+             'SELECT (SELECT MIN(table_name) FROM tables) '
+             '           AS first_table_name, '
+             '       ARRAY(SELECT table_name FROM tables '
+             '             WHERE creation_time >= '
+             '                   TIMESTAMP_SECONDS(@window_start)) '
+             '           AS recent_table_names' % _HOURLY_DATASET)
+    window_start_t = int(
+        window_start.replace(tzinfo=datetime.timezone.utc).timestamp())
+    result = _query_rows(query, _query_parameters(
+        window_start=window_start_t))[0]
+
+    table_names = frozenset(result['recent_table_names'])
+    if result['first_table_name'] is None:
+        # Every table name sorts after this one.
+        first_table_name = ''
         start_time = midnight
     else:
-        all_hourly_tables = json.loads(output)
-        table_names = sorted(d['tableId'] for d in all_hourly_tables
-                             if d['tableId'].startswith('requestlogs_'))
-        start_time = end_time - datetime.timedelta(days=6)
+        first_table_name = result['first_table_name']
+        start_time = window_start
 
     retval = []
     hour = start_time
@@ -415,17 +628,78 @@ def _times_of_missing_tables(end_time):
         # that.
         if hour >= datetime.datetime(2017, 7, 13, 0, 0, 0):
             break
-        table_name = hour.strftime('requestlogs_%Y%m%d_%H')
+        table_name = hour.strftime(_HOURLY_TABLE_ID_FORMAT)
         if (table_name not in table_names and
                 # Ignore candidate tables before the first table in our dataset
-                table_name > table_names[0]):
+                table_name > first_table_name):
             retval.append(hour)
         hour += datetime.timedelta(hours=1)
 
     return retval
 
 
-def _create_hourly_table(start_time, search_harder_for_loglines,
+def _vm_modules_query_fields():
+    """The field-lists that our hourly-table queries need, as a dict.
+
+    These are all computed from the schema of the streaming logs
+    table, which doesn't change while we're running, so main()
+    calls this once and passes the result to every hour it builds.
+    """
+    streaming_schema = update_schema.schema('khan-academy',
+                                            'logs_streaming.logs_all_time')
+    # These are fields that we derive from the 'KALOG' app-log logline.
+    kalog_fields = []
+    # These are fields that we take from the request-log.
+    reqlog_fields = []
+    # And this is all the fields we output, in the same order as the
+    # streaming schema, so the hourly tables' columns are in that
+    # order too.  The vm-modules query lists them the same way, but
+    # with NULL for the fields it doesn't compute.
+    hourly_table_fields = []
+    vm_hourly_table_fields = []
+    for field in streaming_schema:
+        name = field['name']
+        hourly_table_fields.append(name)
+        if name == 'app_logs':
+            pass       # this is the field that we take from the app-log
+        elif name.startswith('bingo_'):
+            # The query hard-codes the bingo fields.
+            if name not in ('bingo_participation_events',
+                            'bingo_conversion_events'):
+                vm_hourly_table_fields.append('NULL as %s' % name)
+                continue
+        elif name.startswith('elog_'):
+            kalog_fields.append(name)
+        else:
+            reqlog_fields.append(name)
+        vm_hourly_table_fields.append(name)
+
+    return {
+        'reqlog_fields': ', '.join(reqlog_fields),
+        'concatted_kalog_fields': ', '.join(
+            ["ANY_VALUE(IF(app_log.elog_country is not null, "
+             "app_log.%s, NULL)) as %s" % (f, f) for f in kalog_fields]),
+        'hourly_table_fields': ', '.join(hourly_table_fields),
+        'vm_hourly_table_fields': ', '.join(vm_hourly_table_fields),
+    }
+
+
+def _schema_field_names(schema, prefix=''):
+    """Return the set of dotted names of all the fields in schema.
+
+    schema is a list of fields, as returned by update_schema.schema().
+    The sub-fields of record fields are included, as "record.subfield".
+    """
+    retval = set()
+    for field in schema:
+        name = prefix + field['name']
+        retval.add(name)
+        if field['type'] == 'RECORD':
+            retval |= _schema_field_names(field['fields'], name + '.')
+    return retval
+
+
+def _create_hourly_table(start_time, query_fields, search_harder_for_loglines,
                          interactive=False, dry_run=False):
     """Copy an hour's worth of logs from streaming to a new table.
 
@@ -442,89 +716,50 @@ def _create_hourly_table(start_time, search_harder_for_loglines,
     been delivered way out of order; so much so that they may have
     come in hours or days after start_time.
 
-    This raises an error if the table already exists.
+    query_fields is the dict returned by _vm_modules_query_fields().
+
+    This does not touch the daily table; _update_daily_tables() does
+    that.  We return True if we created the hourly table, or False if
+    it already existed.
     """
-    daily_table = start_time.strftime(_DAILY_DATASET + '.requestlogs_%Y%m%d')
     hourly_table = _hourly_table_name(start_time)
-    # We use a random number to avoid collisions if we try to process the
-    # same hour multiple times.
-    vm_subtable = start_time.strftime(_HOURLY_DATASET + '.subquery_%Y%m%d_%H' +
-                                      '__%s' % random.randint(0, 9999))
-
-    streaming_schema = update_schema.schema('khan-academy',
-                                            'logs_streaming.logs_all_time')
-    # This is the field that we take from the app-log.
-    applog_fields = ['app_logs']
-    # These are fields that we derive from the 'KALOG' app-log logline.
-    kalog_fields = sorted(f['name'] for f in streaming_schema
-                           if f['name'].startswith('elog_'))
-    bingo_fields = sorted(f['name'] for f in streaming_schema
-                           if f['name'].startswith('bingo_'))
-    # These are fields that we take from the request-log.
-    reqlog_fields = sorted(f['name'] for f in streaming_schema
-                           if f['name'] not in (applog_fields + kalog_fields +
-                                                bingo_fields))
 
-    start_time_t = calendar.timegm(start_time.timetuple())
+    start_time_t = int(
+        start_time.replace(tzinfo=datetime.timezone.utc).timestamp())
     end_time_t = start_time_t + 3600
-    sql_dict = {
-        'start_time': start_time_t,
-        'end_time': end_time_t,
-        'start_ms': (start_time_t - 10 * 60) * 1000,
-        'end_ms': (int(time.time()) * 1000 if search_harder_for_loglines
-                   else _table_decorator_end_time(end_time_t)),
-        'vm_filtered_temptable': vm_subtable,
-        'reqlog_fields': ', '.join(reqlog_fields),
-        'kalog_fields': ', '.join(kalog_fields),
-        'concatted_kalog_fields': ', '.join(
-            ["ANY_VALUE(kalog_line.%s) as %s" % (f, f) for f in kalog_fields]),
+    query_params = _query_parameters(
+        start_time=start_time_t,
+        end_time=end_time_t,
+        start_ms=(start_time_t - 10 * 60) * 1000,
+        end_ms=(_now() * 1000 if search_harder_for_loglines
+                else _table_decorator_end_time(end_time_t)))
+
+    # Create the hourly table.
+    logging.info("Creating a new hourly table: %s", hourly_table)
+    script = _CREATE_HOURLY_TABLE_SCRIPT % {
+        'hourly_table': hourly_table,
+        'hourly_logs_query': _HOURLY_LOGS_QUERY,
+        'non_vm_query': _NON_VM_SUBTABLE_QUERY % query_fields,
+        'vm_modules_query': _VM_MODULES_QUERY % query_fields,
+        'histogram_query': _HOURLY_HISTOGRAM_QUERY % {
+            'hourly_table': hourly_table},
     }
-
-    # If the hourly table already exists, then we have a noop.
     try:
-        with open(os.devnull, 'w') as devnull:
-            _call_bq(['show', hourly_table], stdout=devnull, stderr=devnull)
+        rows = list(_wait_for_job(_start_query(
+            script, query_params, interactive=interactive, dry_run=dry_run)))
+    except api_exceptions.Conflict:
+        # main() only asks for hours whose table didn't exist, but
+        # another run may have made it since.  If so, we have a noop.
         logging.warning("Skipping %s -- already exists", hourly_table)
-        return
-    except subprocess.CalledProcessError:    # means 'table does not exist'
-        pass
+        return False
 
-    # We need to `mk` our temp-table so we can give it an expiry.
-    # We do this even in dry-run mode so the hourly table doesn't
-    # fail due to a missing subquery table.
-    _call_bq(['mk', '--expiration', str(50 * 60), '-t', vm_subtable])
+    _check_for_shutdown()
 
-    _BQ_QUERY = ['query', '--allow_large_results', '--noflatten']
-    if not interactive:
-        _BQ_QUERY.append('--batch')
-    if dry_run:
-        _BQ_QUERY.append('--dry_run')
-
-    # Create the temp-table that just holds the Managed VM loglines.
-    _call_bq(_BQ_QUERY +
-             ['--destination_table', vm_subtable,
-              _sanitize_query(_VM_SUBTABLE_QUERY % sql_dict)])
-
-    # Create the hourly table in two steps.  (Ideally we'd just do one
-    # step so creating the hourly table was atomic, but sadly we can't
-    # use legacy sql for the [very complicated] vm-modules query, and
-    # standard sql doesn't support table decorators yet.)
-    # The non-vm modules come first; they're very simple.
-    logging.info("Creating a new hourly table: %s", hourly_table)
-    logging.info("-- adding logs from non-vm modules")
-    _call_bq(_BQ_QUERY +
-             ['--destination_table', hourly_table,
-              _sanitize_query(_NON_VM_SUBTABLE_QUERY % sql_dict)])
-
-    logging.info("-- adding logs from vm modules")
-    _call_bq(_BQ_QUERY +
-             ['--append', '--nouse_legacy_sql',
-              '--destination_table', hourly_table,
-              _sanitize_query(_VM_MODULES_QUERY % sql_dict)])
-
-    # Sanity check on the hourly logs.
+    # Sanity check on the hourly logs.  (A dry run doesn't give us
+    # a histogram to check.)
     try:
-        _assert_hourly_logs_seem_complete(start_time)
+        if not dry_run:
+            _assert_hourly_logs_seem_complete(start_time, rows[0])
     except HourlyTableIncomplete as e:
         if (datetime.datetime.utcnow() - start_time
                 > datetime.timedelta(hours=12)):
@@ -543,19 +778,87 @@ def _create_hourly_table(start_time, search_harder_for_loglines,
             _remove_tables_at_time(start_time)
             raise
 
+    return True
+
+
+def _append_to_daily_table(hourly_table_times, dry_run=False):
+    """Append the hourly tables at the given times to their daily table.
+
+    The times should all be on the same day.  We append all the
+    hourly tables with a single copy job, which is atomic: either
+    they all get appended or none do.  If we're told to shut down
+    while it runs, we raise RaisedSignal only if it didn't go through.
+    """
+    daily_table = hourly_table_times[0].strftime(_DAILY_TABLE_FORMAT)
+    hourly_tables = [_hourly_table_name(t) for t in hourly_table_times]
+
     # Call update_schema to make sure that the daily table has all the
-    # columns the hourly table does, in case some just got added.
-    # Otherwise the `cp` command below will fail.  (This doesn't work
-    # in dry_run mode, where the hourly table was never created.)
+    # columns the hourly tables do, in case some just got added.
+    # Otherwise the copy below will fail.  (This doesn't work
+    # in dry_run mode, where the hourly tables were never created.)
+    # All our hourly tables are made by the same query, so they all
+    # have the same schema.  Usually nothing got added, so we check
+    # that first.
     if not dry_run:
-        hourly_table_schema = update_schema.schema(_PROJECT, hourly_table)
-        update_schema.merge_and_update_schema(_PROJECT, daily_table,
-                                              merge_with=hourly_table_schema)
+        hourly_table_schema = update_schema.schema(_PROJECT, hourly_tables[0])
+        daily_table_schema = update_schema.schema(_PROJECT, daily_table)
+        if not (_schema_field_names(hourly_table_schema)
+                <= _schema_field_names(daily_table_schema)):
+            update_schema.merge_and_update_schema(
+                _PROJECT, daily_table, merge_with=hourly_table_schema,
+                orig_schema=daily_table_schema)
 
     # Update the daily table.
     logging.info("Updating daily table: %s", daily_table)
-    _call_bq(['cp', '--append_table', hourly_table, daily_table],
-             dry_run=dry_run)
+    if dry_run:
+        logging.info("Would append %s to %s",
+                     ", ".join(hourly_tables), daily_table)
+    else:
+        job = _client().copy_table(
+            hourly_tables, daily_table,
+            job_config=bigquery.CopyJobConfig(
+                write_disposition=bigquery.WriteDisposition.WRITE_APPEND))
+        try:
+            _wait_for_job(job)
+        except RaisedSignal:
+            if job.error_result is not None:
+                raise
+            # We were too late to cancel the copy: the hourly tables
+            # are in the daily table now, so we have to keep them, or
+            # the next run would rebuild them and append them again.
+            # We still shut down, just after this day.
+            logging.info("Received a signal, but %s was already updated",
+                         daily_table)
+            _SHUTDOWN.set()
+
+
+def _update_daily_tables(hourly_table_times, dry_run):
+    """Append the hourly tables at the given times to the daily tables.
+
+    We do one copy job per day.  If appending some day's hourly tables
+    fails, we delete them so the next run will try again, and go on
+    to the other days.
+    """
+    times_by_day = {}
+    for t in sorted(hourly_table_times):
+        times_by_day.setdefault(t.date(), []).append(t)
+
+    for day in sorted(times_by_day):
+        times = times_by_day[day]
+        try:
+            _check_for_shutdown()
+            _append_to_daily_table(times, dry_run=dry_run)
+        except RaisedSignal as e:
+            logging.info("Received a signal: %s.  Deleting logs-in-process "
+                         "for %s", e, day)
+            _SHUTDOWN.set()
+            for t in times:
+                _remove_tables_at_time(t)
+        except Exception as e:
+            logging.warning("Error updating daily table for %s, deleting "
+                            "its hourly tables to be safe: %s", day, e)
+            for t in times:
+                _remove_tables_at_time(t)
 
 
 def setup_logging(verbose):
@@ -573,7 +876,9 @@ def setup_logging(verbose):
     """
     logger = logging.getLogger()
     # Have to set the root logger level, it defaults to logging.WARNING.
-    logger.setLevel(logging.NOTSET)
+    # We set it no lower than we'll print, so that code which checks
+    # isEnabledFor() can skip building debug output we'd throw away.
+    logger.setLevel(logging.DEBUG if verbose else logging.INFO)
 
     logs_format = '[%(asctime)s %(levelname)s] %(message)s'
     formatter = logging.Formatter(logs_format)
@@ -592,9 +897,9 @@ def setup_logging(verbose):
 def _remove_tables_at_time(table_time):
     table = _hourly_table_name(table_time)
     try:
-        _call_bq(['rm', '-t', '-f', table])
-    except subprocess.CalledProcessError:
-        # It didn't exist or we couldn't delete it.
+        _client().delete_table(table, not_found_ok=True)
+    except api_exceptions.GoogleAPIError:
+        # We couldn't delete it.
         pass
 
 
@@ -602,16 +907,72 @@ class RaisedSignal(Exception):
     pass
 
 
-def _signal_handler(signal_number, _stackframe):
-    signals_to_names = dict((getattr(signal, n), n)
-        for n in dir(signal) if n.startswith('SIG') and '_' not in n)
+# Computed once, so the signal handler doesn't have to.
+_SIGNAL_NAMES = dict((getattr(signal, n), n)
+    for n in dir(signal) if n.startswith('SIG') and '_' not in n)
+
 
+def _signal_handler(signal_number, _stackframe):
     # Throw an exception from the signal_handler to hit the catch clause.
-    raise RaisedSignal("Caught signal %s" % signals_to_names[signal_number])
+    raise RaisedSignal("Caught signal %s"
+                       % _SIGNAL_NAMES.get(signal_number, signal_number))
+
+
+def _process_hour(hourly_table_time, query_fields, interactive, dry_run):
+    """Create the hourly table for the given time.
+
+    If anything goes wrong, we delete the hourly table so the next
+    run will try again.  This is run in a worker thread by main().
+    We return True if we created a table that needs to be appended
+    to its daily table.
+    """
+    printable_time = hourly_table_time.ctime()
+
+    logging.info("Processing logs at %s (UTC)", printable_time)
+    try:
+        try:
+            created = _create_hourly_table(
+                hourly_table_time, query_fields,
+                search_harder_for_loglines=False,
+                interactive=interactive, dry_run=dry_run)
+        except HourlyTableIncomplete:
+            # Try again, but searching over more of logs_streaming for
+            # the loglines: maybe they're just way out-of-order.
+            logging.info("Trying %s again, but searching harder "
+                         "for those missing loglines", printable_time)
+            created = _create_hourly_table(
+                hourly_table_time, query_fields,
+                search_harder_for_loglines=True,
+                interactive=interactive, dry_run=dry_run)
+    except RaisedSignal:
+        logging.info("Deleting logs-in-process for %s", printable_time)
+        _remove_tables_at_time(hourly_table_time)
+        return False
+    except Exception as e:
+        if 'Already Exists' in str(e):
+            # A CREATE TABLE in a script doesn't always fail with a
+            # Conflict, so _create_hourly_table() may not have caught
+            # this.  Either way the table is another run's, not ours
+            # to delete.
+            logging.warning("Skipping %s -- already exists", printable_time)
+            return False
+        logging.warning("Error creating tables for "
+                        "%s, deleting it to be safe: %s", printable_time, e)
+        _remove_tables_at_time(hourly_table_time)
+        return False
+
+    logging.info("DONE processing logs at %s (UTC)", printable_time)
+    return created
 
 
 def main(interactive, dry_run):
-    """Populate any hourly and daily tables that still need it."""
+    """Populate any hourly and daily tables that still need it.
+
+    We build several hourly tables at once, each in its own thread.
+    If one hour fails we still go on to do the others.  As soon as all
+    of a day's hours are done, we append the ones we built to that
+    day's daily table, while the other days' hours keep building.
+    """
     now = datetime.datetime.utcnow()
     start_of_this_hour = datetime.datetime(now.year, now.month, now.day,
                                            now.hour)
@@ -619,35 +980,55 @@ def main(interactive, dry_run):
     logging.info("Creating the following log-tables: %s",
                  ", ".join(_hourly_table_name(h) for h in times_to_build))
 
-    for next_hourly_table_time in times_to_build:
-        printable_time = next_hourly_table_time.ctime()
+    if not times_to_build:
+        return
+
+    query_fields = _vm_modules_query_fields()
 
-        logging.info("Processing logs at %s (UTC)", printable_time)
+    # How many of each day's hours are still being built.
+    hours_left = collections.Counter(t.date() for t in times_to_build)
+    # The hours we've built, by day, for days we haven't appended yet.
+    built_times = {}
+    # The days whose hours we've appended to their daily table.
+    appended_days = set()
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=_MAX_CONCURRENT_HOURS) as executor:
+        futures = {executor.submit(_process_hour, t, query_fields,
+                                   interactive, dry_run): t
+                   for t in times_to_build}
         try:
-            try:
-                _create_hourly_table(next_hourly_table_time,
-                                     interactive, dry_run)
-            except HourlyTableIncomplete:
-                # Try again, but searching over more of logs_streaming for
-                # the loglines: maybe they're just way out-of-order.
-                logging.info("Trying this hour again, but searching harder "
-                             "for those missing loglines")
-                _create_hourly_table(next_hourly_table_time,
-                                     search_harder_for_loglines=True,
-                                     interactive=interactive, dry_run=dry_run)
+            for future in concurrent.futures.as_completed(futures):
+                day = futures[future].date()
+                if future.result():
+                    built_times.setdefault(day, []).append(futures[future])
+                hours_left[day] -= 1
+                if hours_left[day] == 0 and day in built_times:
+                    # We append right away, rather than after every
+                    # hour is done, so if we die while other days are
+                    # still building, this day's hours aren't lost.
+                    _update_daily_tables(built_times.pop(day), dry_run)
+                    appended_days.add(day)
+                # _update_daily_tables() tells us if it got a signal.
+                _check_for_shutdown()
         except RaisedSignal as e:
+            # Signals are always delivered to the main thread, so it's
+            # our job to tell the worker threads to stop.  They delete
+            # their in-process tables on their way out; we wait for
+            # that when we leave this `with`.
             logging.info("Received a signal: %s.  Deleting logs-in-process "
-                         "for %s and exiting", e, printable_time)
-            _remove_tables_at_time(next_hourly_table_time)
-            return
-        except Exception as e:
-            logging.warning("Error creating tables for "
-                "%s, deleting it to be safe: %s" % (printable_time, e))
-            _remove_tables_at_time(next_hourly_table_time)
-            # Move on to the next log, see if we can process that one.
-            continue
-
-        logging.info("DONE processing logs at %s (UTC)", printable_time)
+                         "and exiting", e)
+            _SHUTDOWN.set()
+            for future in futures:
+                future.cancel()
+
+    if _SHUTDOWN.is_set():
+        # The hours we finished for days we never got to append never
+        # made it into the daily tables, so they have to go too.
+        for (future, t) in futures.items():
+            if (t.date() not in appended_days and
+                    not future.cancelled() and future.result()):
+                _remove_tables_at_time(t)
 
 
 if __name__ == '__main__':
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 """Update the logs_streaming schema to match what the streaming job wants.
 
@@ -12,34 +12,62 @@ You should run this whenever adding new elog fields to
 EventLogParser.java.  To make it easy to remember, we run the script
 automatically in the Makefile.
 
-This script needs the 'bq' binary to be installed and authenticated.
+This script needs the google-cloud-bigquery python package to be
+installed and authenticated.
 """
 
+import concurrent.futures
+import copy
 import difflib
 import json
 import logging
-import pprint
 import subprocess
-import tempfile
+import time
 
+from google.api_core import exceptions as api_exceptions
+from google.cloud import bigquery
 
-_BQ = ['bq', '-q', '--format=json', '--headless']
 
+# How long schema() trusts a schema it has already fetched, in seconds.
+_SCHEMA_CACHE_SECONDS = 60
 
-def _bq(project, command_list):
+# Map from (project, table_name) to (time.monotonic() when we fetched
+# it, schema).  We only cache tables that exist.
+_SCHEMA_CACHE = {}
+
+# Map from project to the bigquery client we use for it.
+_CLIENTS = {}
+
+
+def _client(project):
     """project is likely khan-academy or khanacademy.org:deductive-jet-827."""
-    data = subprocess.check_output(_BQ + ['--project_id', project] +
-                                   command_list)
-    return json.loads(data)
+    if project not in _CLIENTS:
+        _CLIENTS[project] = bigquery.Client(project=project)
+    return _CLIENTS[project]
 
 
 def schema(project, table_name):
-    """project is likely khan-academy or khanacademy.org:deductive-jet-827."""
+    """project is likely khan-academy or khanacademy.org:deductive-jet-827.
+
+    We cache the result for a little while.  Callers are free to
+    modify the schema we return; it's their own copy.
+    """
+    cached = _SCHEMA_CACHE.get((project, table_name))
+    if cached and time.monotonic() - cached[0] < _SCHEMA_CACHE_SECONDS:
+        return copy.deepcopy(cached[1])
+
     try:
-        data = _bq(project, ['show', table_name])
-    except subprocess.CalledProcessError:    # probably 'table does not exist'
+        table = _client(project).get_table(table_name)
+    except api_exceptions.NotFound:
         return []
-    return data['schema']['fields']
+    fields = [field.to_api_repr() for field in table.schema]
+    _SCHEMA_CACHE[(project, table_name)] = (time.monotonic(), fields)
+    return copy.deepcopy(fields)
+
+
+def invalidate(project, table_name):
+    """Forget what schema() cached for this table, e.g. after changing it."""
+    _SCHEMA_CACHE.pop((project, table_name), None)
 
 
 def _schema_from_java():
@@ -50,7 +78,7 @@ def _schema_from_java():
 
 
 def _merge_schemas(streaming_schema, schema_that_java_will_write):
-    """Returns streaming_schema + logs_schema.
+    """Adds logs_schema to streaming_schema, in place, and returns it.
 
     Each entry of foo_schema looks like this:
       {
@@ -65,21 +93,36 @@ def _merge_schemas(streaming_schema, schema_that_java_will_write):
         "name": "app_logs",
         "type": "RECORD"
       },
-    We recurse on the latter.
-    """
-    streaming_schema = streaming_schema[:]    # make a local copy
-
-    # First, let's get a more efficient representation of streaming_schema.
-    streaming_map = {field['name']: field for field in streaming_schema}
+    For the latter, we merge sub-fields into the record field of
+    streaming_schema in place as well.  Callers that need to keep the
+    original streaming_schema should pass in a copy.
 
-    for logs_field in schema_that_java_will_write:
-        if logs_field['name'] not in streaming_map:
-            streaming_schema.append(logs_field)
-        elif logs_field['type'] == 'RECORD':
-            # We need to recursively merge the sub-fields of the record.
-            streaming_field = streaming_map[logs_field['name']]
-            streaming_field['fields'] = _merge_schemas(
-                logs_field['fields'], streaming_field['fields'])
+    We delete the modes of (copies of) the fields we add, as
+    _delete_mode() does, while we're at it.  streaming_schema should already have had its
+    modes deleted, so that the whole result is normalized the same way.
+    """
+    # A list of (streaming field-list, logs field-list) pairs we still
+    # need to merge; record fields add their sub-fields to it.
+    to_do = [(streaming_schema, schema_that_java_will_write)]
+    while to_do:
+        (streaming_fields, logs_fields) = to_do.pop()
+        # First, let's get a more efficient representation of
+        # streaming_fields.
+        streaming_map = {field['name']: field for field in streaming_fields}
+
+        for logs_field in logs_fields:
+            streaming_field = streaming_map.get(logs_field['name'])
+            if streaming_field is None:
+                # Copy it, so deleting its modes doesn't change the
+                # caller's schema_that_java_will_write.
+                logs_field = copy.deepcopy(logs_field)
+                _delete_mode([logs_field])
+                streaming_fields.append(logs_field)
+                # In case logs_field shows up again, don't add it twice.
+                streaming_map[logs_field['name']] = logs_field
+            elif logs_field['type'] == 'RECORD':
+                # We need to merge the sub-fields of the record too.
+                to_do.append((streaming_field['fields'], logs_field['fields']))
 
     return streaming_schema
 
@@ -91,20 +134,24 @@ def _delete_mode(schema):
     which is the default, so we ignore the "mode" entry on all logs
     fields unless it is "REPEATED".
     """
-    for field in schema:
-        if field.get('mode') != "REPEATED":
-            field.pop('mode', None)
-        if field['type'] == 'RECORD':
-            _delete_mode(field['fields'])
+    # We walk record fields with a stack of field-lists still to do,
+    # rather than recursing.
+    to_do = [schema]
+    while to_do:
+        for field in to_do.pop():
+            if field.get('mode') != "REPEATED":
+                field.pop('mode', None)
+            if field['type'] == 'RECORD':
+                to_do.append(field['fields'])
 
 
 def _update_schema(project, table_name, new_schema):
-    with tempfile.NamedTemporaryFile(prefix='streaming_schema_') as f:
-        json.dump(new_schema, f)
-        f.flush()
-        # We don't call _bq here because it doesn't return json!
-        subprocess.check_call(_BQ + ['--project_id', project] +
-                              ['update', '--schema=%s' % f.name, table_name])
+    client = _client(project)
+    table = client.get_table(table_name)
+    table.schema = [bigquery.SchemaField.from_api_repr(field)
+                    for field in new_schema]
+    client.update_table(table, ['schema'])
+    invalidate(project, table_name)
 
 
 def _log_diff(new_schema, orig_schema):
@@ -112,32 +159,51 @@ def _log_diff(new_schema, orig_schema):
     if orig_schema == new_schema:
         return
 
-    logging.info("New schema: %s",
-                 json.dumps(new_schema, sort_keys=True, indent=4))
-    # This diffing is taken from unittest.case.assertSequenceEqual
+    # The full schema is big, so we only build the text if -v asked
+    # for it; the diff below is usually all anyone needs.
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("New schema: %s",
+                      json.dumps(new_schema, sort_keys=True, indent=4))
+    # We diff one line of json per top-level field, which keeps the
+    # diff short and cheap even for big record fields like app_logs.
     logging.info("Diff:")
-    logging.info("\n".join(difflib.ndiff(
-        pprint.pformat(orig_schema).splitlines(),
-        pprint.pformat(new_schema).splitlines())))
+    logging.info("\n".join(difflib.unified_diff(
+        [json.dumps(field, sort_keys=True) for field in orig_schema],
+        [json.dumps(field, sort_keys=True) for field in new_schema],
+        'orig_schema', 'new_schema', n=1, lineterm='')))
 
 
-def merge_and_update_schema(project, table, merge_with, dry_run=False):
+def merge_and_update_schema(project, table, merge_with, dry_run=False,
+                            orig_schema=None):
     """Update the schema of table to include columsn in merge_with.
 
     After this is run, the table called `table` in project `project`
     will include all the columns it used to have, plus the columns in
     `merge_with` that it did not have before.
-    """
-    orig_schema = schema(project, table)
-    new_schema = _merge_schemas(orig_schema, merge_with)
-    _delete_mode(new_schema)
 
-    _log_diff(new_schema, orig_schema)
+    If the caller already has the table's current schema, as returned
+    by schema(), it can pass it in as `orig_schema` and we won't fetch
+    it again.
+    """
+    if orig_schema is None:
+        orig_schema = schema(project, table)
+    # We compare against the original schema with its modes deleted
+    # the same way as for new_schema, so a schema that differs only in
+    # modes we'd delete anyway doesn't count as a change.  (We copy it
+    # first since _merge_schemas() modifies its argument in place.)
+    # _merge_schemas() deletes the modes of the fields it adds, so
+    # new_schema comes out normalized too.
+    normalized_orig_schema = copy.deepcopy(orig_schema)
+    _delete_mode(normalized_orig_schema)
+    new_schema = _merge_schemas(copy.deepcopy(normalized_orig_schema),
+                                merge_with)
+
+    _log_diff(new_schema, normalized_orig_schema)
 
     if not orig_schema:
         logging.info("Creating a new table, will create a new "
                      "schema automatically.")
-    elif new_schema == orig_schema:
+    elif new_schema == normalized_orig_schema:
         logging.info("Not updating schema, no changes found.")
     elif dry_run:
         logging.info("Not updating schema, dry-run specified.")
@@ -147,12 +213,19 @@ def merge_and_update_schema(project, table, merge_with, dry_run=False):
 
 
 def main(project, table, dry_run=False):
-    logging.info("Getting schema that the java streaming job is expecting")
-    schema_that_java_will_write = _schema_from_java()
+    # Building the java code and fetching the existing schema don't
+    # depend on each other, so we do them at the same time.
+    logging.info("Getting schema that the java streaming job is expecting, "
+                 "and the existing schema")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        java_future = executor.submit(_schema_from_java)
+        orig_schema_future = executor.submit(schema, project, table)
+        schema_that_java_will_write = java_future.result()
+        orig_schema = orig_schema_future.result()
 
     logging.info("Merging and updating existing schema")
     merge_and_update_schema(project, table, schema_that_java_will_write,
-                            dry_run)
+                            dry_run, orig_schema=orig_schema)
 
     logging.info("DONE")
 